@@ -13,91 +13,493 @@
 """
 
 import argparse
+import io
+import json
 import os
 import re
 import shutil
 import sys
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Dict, Iterator, List, Tuple, Optional
 
 try:
-    from PIL import Image
-    import pillow_heif
-except ImportError:
-    print("❌ Ошибка: Не установлены необходимые библиотеки.")
-    print("Установите зависимости: pip install -r requirements.txt")
-    sys.exit(1)
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-# Регистрируем HEIC формат
-pillow_heif.register_heif_opener()
+# Pillow и pillow_heif импортируются лениво в _load_pillow():
+# dry-run только печатает имена файлов и не должен платить за их загрузку
+Image = ImageCms = ImageOps = features = pillow_heif = None
+
+# libvips - опциональный потоковый бэкенд (--backend vips), тоже грузится лениво:
+# import pyvips подгружает нативную libvips через cffi
+pyvips = None
+
+_heif_registered = False
+
+
+def _register_heif_opener() -> None:
+    """Регистрирует HEIC формат (один раз на процесс)"""
+    global _heif_registered
+    if not _heif_registered:
+        pillow_heif.register_heif_opener()
+        _heif_registered = True
+
+
+def _load_pillow() -> None:
+    """
+    Импортирует Pillow и pillow_heif при первом реальном использовании
+    и регистрирует HEIC формат. Повторные вызовы ничего не делают.
+    """
+    global Image, ImageCms, ImageOps, features, pillow_heif
+    if Image is not None:
+        return
+
+    try:
+        from PIL import Image, ImageCms, ImageOps, features
+        import pillow_heif
+    except ImportError as e:
+        raise ImportError(
+            "Не установлены необходимые библиотеки. "
+            "Установите зависимости: pip install -r requirements.txt"
+        ) from e
+
+    # AVIF: в Pillow >= 11.2 поддержка встроена, для более старых нужен pillow-avif-plugin
+    try:
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+    # Регистрируем HEIC формат
+    _register_heif_opener()
+
+
+def _load_pyvips() -> None:
+    """
+    Импортирует pyvips при первом использовании бэкенда vips.
+    Повторные вызовы ничего не делают.
+    """
+    global pyvips
+    if pyvips is not None:
+        return
+
+    try:
+        import pyvips
+    except (ImportError, OSError) as e:
+        # OSError - pyvips установлен, но не нашёл саму libvips
+        raise ImportError("Для --backend vips нужен pyvips и libvips") from e
+
+
+# Выходные форматы: название для вывода и расширение файла
+FORMAT_LABELS = {'webp': 'WebP', 'avif': 'AVIF', 'jpeg': 'JPEG'}
+FORMAT_EXTENSIONS = {'webp': '.webp', 'avif': '.avif', 'jpeg': '.jpg'}
+
+# Тип файла по расширению
+_EXT_TO_TYPE = {
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.heic': 'heic',
+    '.tif': 'tiff',
+    '.tiff': 'tiff',
+    '.png': 'png',
+    '.webp': 'webp',
+    '.mov': 'video',
+    '.mp4': 'video',
+    '.avi': 'video',
+}
+
+# Режимы, которые Image.resize умеет ресемплировать фильтром LANCZOS
+_RESAMPLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK')
+
+# Ключи img.info с метаданными, которые по умолчанию не попадают в результат
+_METADATA_KEYS = ('exif', 'icc_profile', 'xmp')
+
+# Единицы для format_size
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+# Ссылка на изображение в markdown: ![alt](path)
+_IMG_RE = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+
+# Сколько строк прогресса копить перед выводом в режиме --quiet-progress
+PROGRESS_FLUSH_EVERY = 8
+
+# Запас для box-reduce перед финальным LANCZOS (см. Image.thumbnail)
+RESIZE_REDUCING_GAP = 3.0
+
+# Лимит Pillow против "декомпрессионных бомб": по умолчанию ~89 Мп,
+# поднимаем, чтобы не отклонять большие панорамы
+MAX_IMAGE_PIXELS = 200_000_000
+
+# Манифест в выходной директории: из чего и с какими настройками собран каждый файл
+MANIFEST_NAME = '.optimize_manifest.json'
+
+# ioctl FICLONE из linux/fs.h: reflink (copy-on-write копия) на btrfs/xfs
+FICLONE = 0x40049409
+
+
+def _write_atomic(dst: Path, write: Callable[[Path], None]) -> None:
+    """
+    Записывает файл через временный файл рядом и os.replace.
+    Существующий dst не перезаписывается на месте: если это hardlink
+    (например, в Hugo blog), связь рвётся, а не правится опубликованный файл.
+    При ошибке записи старый файл остаётся целым.
+    """
+    # Расширение сохраняем: по нему libvips выбирает формат
+    tmp = dst.with_name(f'.{dst.stem}.tmp-{os.getpid()}{dst.suffix}')
+    try:
+        write(tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _to_srgb(img: 'Image.Image') -> 'Image.Image':
+    """
+    Переводит изображение со встроенным ICC профилем в sRGB.
+    Без профиля браузер считает цвета sRGB, и фото в Display P3 / Adobe RGB
+    после удаления профиля выглядели бы блёклыми.
+    """
+    icc_profile = img.info.get('icc_profile')
+    if not icc_profile or img.mode not in ('RGB', 'RGBA', 'CMYK', 'L'):
+        return img
+    try:
+        return ImageCms.profileToProfile(
+            img,
+            ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+            ImageCms.createProfile('sRGB'),
+            outputMode='RGBA' if img.mode == 'RGBA' else 'RGB'
+        )
+    except (ImageCms.PyCMSError, OSError, ValueError):
+        # Битый или неподдерживаемый профиль - оставляем цвета как есть
+        return img
+
+
+def _encode_one(
+    input_path: Path,
+    outputs: List[Tuple[Path, str, Dict]],
+    max_width: int,
+    keep_metadata: bool = False
+) -> Tuple[int, int]:
+    """
+    Конвертирует одно изображение во все выходные форматы за одно декодирование.
+    outputs - список (путь, формат, параметры сохранения Pillow).
+    Без keep_metadata EXIF/ICC/XMP не сохраняются: блогу они не нужны.
+    Функция уровня модуля, чтобы её можно было передавать в ProcessPoolExecutor.
+    """
+    _load_pillow()
+    original_size = input_path.stat().st_size
+
+    with Image.open(input_path) as img:
+        # Исходник уже в целевом формате и не больше нужного размера:
+        # повторное кодирование только потеряет качество, просто копируем
+        # (если метаданные нужно вырезать, а они есть - всё же перекодируем)
+        fits = max(img.width, img.height) <= max_width
+        has_metadata = any(key in img.info for key in _METADATA_KEYS)
+        can_copy = fits and (keep_metadata or not has_metadata)
+        to_encode = []
+        for out_path, fmt, save_kwargs in outputs:
+            if can_copy and img.format == fmt.upper():
+                _write_atomic(out_path, lambda tmp: shutil.copy2(input_path, tmp))
+            else:
+                to_encode.append((out_path, fmt, save_kwargs))
+
+        if to_encode:
+            # Для JPEG просим libjpeg-turbo сразу декодировать в уменьшенном масштабе
+            # (IDCT scaling 1/2, 1/4, 1/8) - полное разрешение даже не распаковывается.
+            # thumbnail() тоже вызывает draft(), но по квадратной рамке, и для
+            # неквадратных фото масштаб упирается в короткую сторону - считаем по длинной
+            reduce_factor = int(max(img.width, img.height) / max_width / RESIZE_REDUCING_GAP)
+            if img.format == 'JPEG' and reduce_factor >= 2:
+                img.draft('RGB', (img.width // reduce_factor, img.height // reduce_factor))
+
+            # Режимы, которые resize не умеет ресемплировать (P и 1 - только NEAREST),
+            # приводим к RGB/RGBA заранее. Остальные конвертируем уже после ресайза
+            if img.mode not in _RESAMPLE_MODES:
+                img = img.convert('RGBA' if img.mode == 'P' or 'A' in img.mode else 'RGB')
+
+            # Ресайз - первым шагом. С reducing_gap thumbnail сначала делает дешёвый
+            # box-reduce до размера в RESIZE_REDUCING_GAP раз больше целевого, и LANCZOS
+            # работает уже по нему. Изображение меняется на месте, полноразмерный буфер
+            # освобождается - поворот, ICC и кодирование идут по маленькой копии
+            img.thumbnail(
+                (max_width, max_width),
+                Image.Resampling.LANCZOS,
+                reducing_gap=RESIZE_REDUCING_GAP
+            )
+
+            # Поворачиваем по EXIF Orientation: тег удаляется вместе с EXIF.
+            # Рамка thumbnail квадратная, поэтому поворот после ресайза её не нарушает
+            ImageOps.exif_transpose(img, in_place=True)
+
+            if not keep_metadata:
+                img = _to_srgb(img)
+                for key in _METADATA_KEYS:
+                    img.info.pop(key, None)
+
+            # Конвертируем в RGB/RGBA
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+
+            # Метаданные передаём явно: часть плагинов Pillow по умолчанию
+            # берёт их из img.info, часть - нет
+            metadata = {
+                'exif': img.info.get('exif', b''),
+                'icc_profile': img.info.get('icc_profile', b''),
+                # xmp при сохранении понимают Pillow >= 11 (WebP - и раньше)
+                'xmp': img.info.get('xmp', b'')
+            }
+
+            # Одно декодированное изображение сохраняем во все форматы
+            for out_path, fmt, save_kwargs in to_encode:
+                out_img = img
+                if fmt == 'jpeg' and img.mode == 'RGBA':
+                    # JPEG не поддерживает прозрачность - кладём на белый фон
+                    out_img = Image.new('RGB', img.size, (255, 255, 255))
+                    out_img.paste(img, mask=img.getchannel('A'))
+                _write_atomic(
+                    out_path,
+                    lambda tmp: out_img.save(tmp, fmt.upper(), **save_kwargs, **metadata)
+                )
+
+    new_size = sum(out_path.stat().st_size for out_path, _, _ in outputs)
+    return original_size, new_size
+
+
+def _vips_supports_heif() -> bool:
+    """Проверяет, собран ли libvips с libheif (иначе HEIC читаем через Pillow)"""
+    _load_pyvips()
+    return pyvips.type_find('VipsOperation', 'heifload') != 0
+
+
+def _encode_one_vips(
+    input_path: Path,
+    outputs: List[Tuple[Path, str, Dict]],
+    max_width: int,
+    keep_metadata: bool = False
+) -> Tuple[int, int]:
+    """
+    Конвертирует одно изображение через libvips.
+    thumbnail() декодирует в уменьшенном масштабе и ресайзит потоково по тайлам,
+    поэтому пиковая память не зависит от размера исходника.
+    Параметры сохранения Pillow из outputs переводятся в параметры libvips.
+    """
+    _load_pyvips()
+    original_size = input_path.stat().st_size
+
+    # new_from_file ленивый - читается только заголовок
+    header = pyvips.Image.new_from_file(str(input_path))
+    loader = header.get('vips-loader') if header.get_typeof('vips-loader') else ''
+    fits = max(header.width, header.height) <= max_width
+    has_metadata = any(header.get_typeof(field) for field in ('exif-data', 'icc-profile-data', 'xmp-data'))
+    can_copy = fits and (keep_metadata or not has_metadata)
+    strip = not keep_metadata
+
+    img = None
+    for out_path, fmt, save_kwargs in outputs:
+        if can_copy and loader.startswith(fmt):
+            _write_atomic(out_path, lambda tmp: shutil.copy2(input_path, tmp))
+            continue
+
+        if img is None:
+            # thumbnail() читает исходник последовательно, и второе сохранение из того же
+            # конвейера упало бы с "out of order read". Уменьшенное изображение небольшое,
+            # поэтому материализуем его в памяти один раз и сохраняем во все форматы
+            img = pyvips.Image.thumbnail(
+                str(input_path), max_width, height=max_width, size='down'
+            ).copy_memory()
+
+        quality = save_kwargs['quality']
+        if fmt == 'avif':
+            _write_atomic(out_path, lambda tmp: img.heifsave(
+                str(tmp), Q=quality, compression='av1', strip=strip
+            ))
+        elif fmt == 'jpeg':
+            out_img = img.flatten(background=255) if img.hasalpha() else img
+            _write_atomic(out_path, lambda tmp: out_img.jpegsave(
+                str(tmp), Q=quality, optimize_coding=True, interlace=True, strip=strip
+            ))
+        else:
+            _write_atomic(out_path, lambda tmp: img.webpsave(
+                str(tmp), Q=quality, effort=save_kwargs.get('method', 4),
+                smart_subsample=True, strip=strip
+            ))
+
+    new_size = sum(out_path.stat().st_size for out_path, _, _ in outputs)
+    return original_size, new_size
+
+
+def _worker_init() -> None:
+    """
+    Инициализирует процесс-воркер пула: HEIC и плагины Pillow
+    загружаются один раз на весь пакет, а не при первом открытии файла.
+    """
+    _load_pillow()
+    Image.init()
+
+
+def _make_executor(parallel: str) -> Executor:
+    """
+    Создаёт пул для обработки изображений:
+    - process: отдельные процессы, лучше всего для больших HEIC/JPEG
+    - thread: потоки (Pillow отпускает GIL при декодировании, ресайзе и кодировании),
+      нет затрат на запуск процессов - выгоднее для мелких картинок и на Windows
+    """
+    if parallel == 'process':
+        return ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_worker_init)
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def _run_jobs(
+    optimizer: 'ImageOptimizer',
+    jobs: List[Tuple[Tuple, List[Tuple[Path, str, Dict]], Optional[Dict]]],
+    parallel: str
+) -> Iterator[Tuple[Tuple, Dict]]:
+    """
+    Выполняет задания (элемент files_to_process, выходные файлы, готовый результат
+    или None) и отдаёт пары (элемент, результат):
+    - none: по очереди в основном процессе, строго в порядке markdown
+    - process/thread: через пул, по мере готовности
+    """
+    if parallel == 'none':
+        for item, outputs, result in jobs:
+            if result is None:
+                file_path, new_name, idx, file_type = item
+                if optimizer.verbose:
+                    print(f"   Обработка: {file_path.name} → {new_name}")
+                result = optimizer.process_image(file_path, outputs, file_type)
+            yield item, result
+        return
+
+    with _make_executor(parallel) as executor:
+        futures = {}
+        for item, outputs, result in jobs:
+            if result is not None:
+                # Готовый Future проходит через тот же as_completed, что и остальные
+                future = Future()
+                future.set_result(result)
+            else:
+                file_path, new_name, idx, file_type = item
+                if optimizer.verbose:
+                    print(f"   Обработка: {file_path.name} → {new_name}")
+                future = executor.submit(optimizer.process_image, file_path, outputs, file_type)
+            futures[future] = item
+
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # Ошибки внутри process_image уже перехвачены, здесь - сбои самого пула
+                result = {'success': False, 'input': item[0].name, 'error': str(e)}
+            yield item, result
 
 
 class ImageOptimizer:
     """Класс для оптимизации изображений"""
 
-    def __init__(self, max_width: int = 1600, quality: int = 82, verbose: bool = False):
+    def __init__(
+        self,
+        max_width: int = 1600,
+        quality: int = 82,
+        verbose: bool = False,
+        method: int = 4,
+        formats: Optional[List[str]] = None,
+        backend: str = 'pillow',
+        keep_metadata: bool = False
+    ):
         self.max_width = max_width
         self.quality = quality
         self.verbose = verbose
+        self.method = method
+        self.formats = formats or ['webp']
+        self.backend = backend
+        self.keep_metadata = keep_metadata
         self.stats: List[Dict] = []
 
-    def convert_to_webp(self, input_path: Path, output_path: Path) -> Tuple[int, int]:
-        """Конвертирует любое изображение в WebP с высоким качеством"""
-        original_size = input_path.stat().st_size
-
-        with Image.open(input_path) as img:
-            # Конвертируем в RGB/RGBA
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            elif img.mode not in ('RGB', 'RGBA'):
-                if 'A' in img.mode or img.mode == 'LA':
-                    img = img.convert('RGBA')
-                else:
-                    img = img.convert('RGB')
-
-            # Изменяем размер если нужно (сохраняя пропорции)
-            if max(img.width, img.height) > self.max_width:
-                if img.width > img.height:
-                    new_width = self.max_width
-                    new_height = int(img.height * (self.max_width / img.width))
-                else:
-                    new_height = self.max_width
-                    new_width = int(img.width * (self.max_width / img.height))
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-            # Сохраняем как WebP с высоким качеством
-            img.save(
-                output_path,
-                'WEBP',
-                quality=self.quality,
-                method=6  # Лучшее сжатие (медленнее, но качественнее)
-            )
-
-        new_size = output_path.stat().st_size
-        return original_size, new_size
-
-    def process_image(self, input_path: Path, output_path: Path, file_type: str) -> Dict:
-        """Обрабатывает одно изображение - конвертирует в WebP"""
+    def save_kwargs(self, output_format: str) -> Dict:
+        """Параметры сохранения Pillow для выходного формата"""
+        if output_format == 'avif':
+            # AVIF обычно на ~30% меньше WebP при сопоставимом качестве
+            return {'quality': self.quality, 'speed': 6}
+        if output_format == 'jpeg':
+            return {'quality': self.quality, 'optimize': True, 'progressive': True}
+        # method=4 в 3-5 раз быстрее method=6 при разнице в размере ~2%
+        return {'quality': self.quality, 'method': self.method}
+
+    def build_outputs(self, output_dir: Path, stem: str) -> List[Tuple[Path, str, Dict]]:
+        """Список выходных файлов для одного изображения: (путь, формат, параметры)"""
+        return [
+            (output_dir / f'{stem}{FORMAT_EXTENSIONS[fmt]}', fmt, self.save_kwargs(fmt))
+            for fmt in self.formats
+        ]
+
+    def build_record(self, input_path: Path, output_format: str, save_kwargs: Dict) -> Dict:
+        """
+        Описание сборки одного выходного файла для манифеста: исходник
+        (имя, размер, mtime) и все настройки, влияющие на результат
+        """
+        stat = input_path.stat()
+        return {
+            'source': input_path.name,
+            'source_size': stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns,
+            'max_width': self.max_width,
+            'format': output_format,
+            'save_kwargs': save_kwargs,
+            'keep_metadata': self.keep_metadata,
+            'backend': self.backend
+        }
+
+    def convert(self, input_path: Path, outputs: List[Tuple[Path, str, Dict]]) -> Tuple[int, int]:
+        """Конвертирует любое изображение во все выходные форматы с высоким качеством"""
+        return _encode_one(input_path, outputs, self.max_width, self.keep_metadata)
+
+    def process_image(
+        self,
+        input_path: Path,
+        outputs: List[Tuple[Path, str, Dict]],
+        file_type: str
+    ) -> Dict:
+        """Обрабатывает одно изображение - конвертирует в WebP (и другие выбранные форматы)"""
         try:
-            # Все форматы конвертируем в WebP
-            orig_size, new_size = self.convert_to_webp(input_path, output_path)
+            # Декодируем и ресайзим один раз, сохраняем во все форматы.
+            # HEIC остаётся на Pillow, если libvips собран без libheif
+            if self.backend == 'vips' and (file_type != 'heic' or _vips_supports_heif()):
+                try:
+                    orig_size, new_size = _encode_one_vips(
+                        input_path, outputs, self.max_width, self.keep_metadata
+                    )
+                except pyvips.Error:
+                    # libheif в сборке libvips может не уметь HEVC (HEIC с iPhone)
+                    # или AV1 encode (AVIF) - тогда конвертируем через Pillow
+                    orig_size, new_size = self.convert(input_path, outputs)
+            else:
+                orig_size, new_size = self.convert(input_path, outputs)
 
             # Определяем действие для статистики
+            target = '+'.join(FORMAT_LABELS[fmt] for _, fmt, _ in outputs)
             format_map = {
-                'jpeg': 'JPEG → WebP',
-                'heic': 'HEIC → WebP',
-                'tiff': 'TIFF → WebP',
-                'png': 'PNG → WebP',
-                'webp': 'WebP оптимизирован'
+                'jpeg': 'JPEG',
+                'heic': 'HEIC',
+                'tiff': 'TIFF',
+                'png': 'PNG',
+                'webp': 'WebP'
             }
-            action = format_map.get(file_type, f'{file_type.upper()} → WebP')
+            source = format_map.get(file_type, file_type.upper())
+            action = f'{target} оптимизирован' if source == target else f'{source} → {target}'
 
+            # Размер после - суммарно по всем выходным форматам
             compression = int((1 - new_size / orig_size) * 100) if orig_size > 0 else 0
 
             return {
                 'success': True,
                 'input': input_path.name,
-                'output': output_path.name,
+                'output': outputs[0][0].name,
+                'outputs': [out_path.name for out_path, _, _ in outputs],
                 'action': action,
                 'original_size': orig_size,
                 'new_size': new_size,
@@ -122,79 +524,147 @@ def find_markdown_file(source_dir: Path) -> Optional[Path]:
     return None
 
 
-def extract_image_references(markdown_content: str) -> List[Tuple[str, str, str]]:
+def extract_image_references(markdown_content: str) -> List[Tuple[Tuple[int, int], str, str]]:
     """
     Извлекает ссылки на изображения из markdown.
-    Возвращает список: (полная строка, alt text, путь к файлу)
+    Возвращает список: ((начало, конец) ссылки в тексте, alt text, путь к файлу)
     """
-    pattern = r'!\[([^\]]*)\]\(([^)]+)\)'
-    matches = re.findall(pattern, markdown_content)
-
-    results = []
-    for alt, path in matches:
-        full_match = f'![{alt}]({path})'
-        results.append((full_match, alt, path))
-
-    return results
+    return [(m.span(), m.group(1), m.group(2)) for m in _IMG_RE.finditer(markdown_content)]
 
 
 def get_file_type(filename: str) -> Optional[str]:
     """Определяет тип файла по расширению"""
-    ext = Path(filename).suffix.lower()
-
-    if ext in ['.jpg', '.jpeg']:
-        return 'jpeg'
-    elif ext == '.heic':
-        return 'heic'
-    elif ext in ['.tif', '.tiff']:
-        return 'tiff'
-    elif ext == '.png':
-        return 'png'
-    elif ext == '.webp':
-        return 'webp'
-    elif ext in ['.mov', '.mp4', '.avi']:
-        return 'video'
-
-    return None
+    return _EXT_TO_TYPE.get(Path(filename).suffix.lower())
 
 
-def find_file_by_basename(attachments_dir: Path, filename: str) -> Optional[Path]:
+def index_attachments(attachments_dir: Path) -> Tuple[Dict[str, Path], Dict[str, Path]]:
+    """
+    Индексирует файлы в Attachments/ за один проход scandir.
+    Возвращает словари: (имя файла → путь, basename → путь)
+    """
+    by_name: Dict[str, Path] = {}
+    by_stem: Dict[str, Path] = {}
+    with os.scandir(attachments_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                path = Path(entry.path)
+                by_name[entry.name] = path
+                by_stem.setdefault(path.stem, path)
+    return by_name, by_stem
+
+
+def find_file_by_basename(
+    by_name: Dict[str, Path],
+    by_stem: Dict[str, Path],
+    filename: str,
+    slow_fallback: bool = False
+) -> Optional[Path]:
     """
-    Находит файл по basename (без расширения).
+    Находит файл по basename (без расширения) в индексе Attachments/.
     Это решает проблему когда файлы имеют разные расширения:
     - file.jpeg vs file.jpg
     - file.heic vs file.jpg
     - file.tiff vs file.png
     """
     # Сначала пробуем точное имя
-    exact_match = attachments_dir / filename
-    if exact_match.exists():
+    exact_match = by_name.get(filename)
+    if exact_match:
         return exact_match
 
     # Извлекаем basename (имя без расширения)
     basename = Path(filename).stem
 
     # Ищем любой файл с этим basename
-    for file in attachments_dir.iterdir():
-        if file.is_file() and file.stem == basename:
-            return file
+    stem_match = by_stem.get(basename)
+    if stem_match:
+        return stem_match
 
     # Дополнительная проверка: если файл называется name.ext1.ext2
-    # (например, file.jpeg.jpg), пробуем найти его
-    for file in attachments_dir.iterdir():
-        if file.is_file() and basename in file.name:
-            return file
+    # (например, file.jpeg.jpg), пробуем найти его перебором
+    if slow_fallback:
+        for name, path in by_name.items():
+            if basename in name:
+                return path
 
     return None
 
 
+def _fast_copy(src: Path, dst: Path, hardlink: bool = True) -> None:
+    """
+    Копирует файл максимально дёшево: reflink (Linux, btrfs/xfs),
+    затем hardlink в пределах одной ФС, иначе обычное копирование.
+    Hardlink безопасен, потому что скрипт пишет выходные файлы только
+    через _write_atomic: повторный запуск заменяет файл в processed/,
+    а не правит общий с Hugo blog inode.
+    """
+    if dst.exists():
+        if os.path.samefile(src, dst):
+            return
+        dst.unlink()
+
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            # ФС не поддерживает reflink или файлы на разных ФС
+            dst.unlink(missing_ok=True)
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+
+
+def load_manifest(output_dir: Path) -> Dict[str, Dict]:
+    """Читает манифест выходной директории (пустой, если его нет или он повреждён)"""
+    try:
+        manifest = json.loads((output_dir / MANIFEST_NAME).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_manifest(output_dir: Path, manifest: Dict[str, Dict]) -> None:
+    """Сохраняет манифест выходной директории"""
+    (output_dir / MANIFEST_NAME).write_text(
+        json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True),
+        encoding='utf-8'
+    )
+
+
+def is_up_to_date(records: Dict[Path, Dict], manifest: Dict[str, Dict]) -> bool:
+    """
+    Проверяет, что каждый выходной файл существует и, судя по манифесту, собран
+    из того же исходника с теми же настройками. Сравнивать только mtime нельзя:
+    имена img_XX позиционные, и после вставки ссылки в markdown под тем же
+    именем должна оказаться другая картинка
+    """
+    for output_path, record in records.items():
+        entry = manifest.get(output_path.name)
+        if not entry or entry.get('build') != record:
+            return False
+        try:
+            if output_path.stat().st_size != entry.get('output_size'):
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
 def format_size(bytes_size: int) -> str:
     """Форматирует размер в читаемый вид"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if bytes_size < 1024.0:
-            return f"{bytes_size:.1f}{unit}"
-        bytes_size /= 1024.0
-    return f"{bytes_size:.1f}TB"
+    if bytes_size < 1024:
+        return f"{bytes_size}B"
+    # Единица измерения по номеру старшего бита: каждые 10 бит - следующая
+    unit_idx = min((bytes_size.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{bytes_size / (1 << (10 * unit_idx)):.1f}{_SIZE_UNITS[unit_idx]}"
 
 
 def validate_source_directory(source_dir: Path) -> Tuple[bool, str]:
@@ -225,9 +695,20 @@ def process_post(
     dry_run: bool,
     no_rename: bool,
     verbose: bool,
-    stats: bool
+    stats: bool,
+    webp_method: int = 4,
+    formats: Optional[List[str]] = None,
+    slow_fallback: bool = False,
+    hardlink: bool = True,
+    backend: str = 'pillow',
+    quiet_progress: bool = False,
+    parallel: str = 'process',
+    keep_metadata: bool = False,
+    force: bool = False
 ) -> bool:
     """Основная функция обработки поста"""
+    formats = formats or ['webp']
+    formats_label = '+'.join(FORMAT_LABELS[fmt] for fmt in formats)
 
     print("🔍 Валидация исходной директории...")
     is_valid, message = validate_source_directory(source_dir)
@@ -241,30 +722,31 @@ def process_post(
     print(f"📄 Найден markdown: {markdown_file.name}")
 
     # Читаем markdown
-    with open(markdown_file, 'r', encoding='utf-8') as f:
-        markdown_content = f.read()
+    markdown_content = markdown_file.read_text(encoding='utf-8')
 
     # Извлекаем ссылки на изображения
     image_refs = extract_image_references(markdown_content)
     print(f"🖼  Найдено ссылок на изображения: {len(image_refs)}")
 
     attachments_dir = source_dir / 'Attachments'
+    # Один проход по Attachments/ обслуживает и поиск файлов, и проверку неиспользуемых
+    by_name, by_stem = index_attachments(attachments_dir)
 
     # Собираем список файлов для обработки (в порядке появления в markdown)
-    files_to_process: List[Tuple[Path, str, int]] = []  # (путь, новое_имя, индекс)
+    files_to_process: List[Tuple[Path, str, int, str]] = []  # (путь, новое_имя, индекс, тип)
     processed_files: set = set()
     missing_files: List[str] = []  # Ссылки есть, но файлов нет
     skipped_videos: List[str] = []  # Пропущенные видео
     unknown_types: List[str] = []  # Неизвестные типы файлов
 
-    for idx, (full_match, alt, path) in enumerate(image_refs, start=1):
+    for idx, (span, alt, path) in enumerate(image_refs, start=1):
         # Извлекаем имя файла из пути
         filename = Path(path).name
         if filename.startswith('Attachments/'):
             filename = filename.replace('Attachments/', '')
 
         # Ищем файл (с поддержкой разных расширений)
-        file_path = find_file_by_basename(attachments_dir, filename)
+        file_path = find_file_by_basename(by_name, by_stem, filename, slow_fallback)
 
         if not file_path:
             missing_files.append(filename)
@@ -292,15 +774,14 @@ def process_post(
         else:
             new_name = f"img_{idx:02d}"
 
-        # Все файлы конвертируются в WebP
-        new_ext = '.webp'
+        # В markdown ссылаемся на первый из выходных форматов
+        new_ext = FORMAT_EXTENSIONS[formats[0]]
 
-        files_to_process.append((file_path, new_name + new_ext, idx))
+        files_to_process.append((file_path, new_name + new_ext, idx, file_type))
         processed_files.add(file_path.name)  # Используем реальное имя файла
 
-    # Проверяем неиспользуемые файлы
-    all_files = set(f.name for f in attachments_dir.iterdir() if f.is_file())
-    unused_files = list(all_files - processed_files)
+    # Проверяем неиспользуемые файлы (по тому же индексу, без повторного обхода)
+    unused_files = list(by_name.keys() - processed_files)
 
     # Краткая сводка перед обработкой
     if missing_files or unused_files:
@@ -314,67 +795,143 @@ def process_post(
         print("\n" + "=" * 70)
         print("🔍 DRY-RUN РЕЖИМ: Предпросмотр без выполнения")
         print("=" * 70)
-        print(f"{'Исходный файл':<35} {'→':<3} {'Новый файл (WebP)':<30}")
+        print(f"{'Исходный файл':<35} {'→':<3} {f'Новый файл ({formats_label})':<30}")
         print("─" * 70)
-        for file_path, new_name, idx in files_to_process:
-            file_type = get_file_type(file_path.name)
+        for file_path, new_name, idx, file_type in files_to_process:
             print(f"{file_path.name:<35} → {new_name:<30}")
         print("─" * 70)
         print(f"📊 Всего файлов к обработке: {len(files_to_process)}")
         print(f"📁 Выходная директория: {output_dir}")
-        print(f"⚙️  Качество WebP: {quality}")
+        print(f"⚙️  Качество {formats_label}: {quality}")
         print(f"📐 Макс размер: {max_width}px")
         if hugo_path:
             print(f"🚀 Hugo path: {hugo_path}")
         print("=" * 70)
         return True
 
+    try:
+        _load_pillow()
+    except ImportError as e:
+        print(f"❌ Ошибка: {e}")
+        return False
+
     # Создаем выходную директорию
     output_dir.mkdir(parents=True, exist_ok=True)
     print(f"\n📁 Выходная директория: {output_dir}")
 
     # Инициализируем оптимизатор
-    optimizer = ImageOptimizer(max_width=max_width, quality=quality, verbose=verbose)
+    optimizer = ImageOptimizer(
+        max_width=max_width,
+        quality=quality,
+        verbose=verbose,
+        method=webp_method,
+        formats=formats,
+        backend=backend,
+        keep_metadata=keep_metadata
+    )
 
     # Обрабатываем изображения
     print("\n🔄 Обработка изображений...\n")
     results: List[Dict] = []
     total_original_size = 0
     total_new_size = 0
+    progress_buf: List[str] = []
+
+    manifest = load_manifest(output_dir)
+    records_by_idx: Dict[int, Dict[Path, Dict]] = {}
+
+    # Задания: (элемент files_to_process, выходные файлы, готовый результат для пропуска)
+    jobs = []
+    for file_path, new_name, idx, file_type in files_to_process:
+        outputs = optimizer.build_outputs(output_dir, Path(new_name).stem)
+        output_paths = [out_path for out_path, _, _ in outputs]
+        records = {
+            out_path: optimizer.build_record(file_path, fmt, save_kwargs)
+            for out_path, fmt, save_kwargs in outputs
+        }
+        records_by_idx[idx] = records
+
+        # Инкрементальная сборка: результат собран из того же исходника
+        # с теми же настройками - не перекодируем
+        skipped = None
+        if not force and is_up_to_date(records, manifest):
+            orig_size = file_path.stat().st_size
+            new_size = sum(out_path.stat().st_size for out_path in output_paths)
+            skipped = {
+                'success': True,
+                'skipped': True,
+                'input': file_path.name,
+                'output': output_paths[0].name,
+                'outputs': [out_path.name for out_path in output_paths],
+                'original_size': orig_size,
+                'new_size': new_size,
+                'compression': int((1 - new_size / orig_size) * 100) if orig_size > 0 else 0
+            }
+        jobs.append(((file_path, new_name, idx, file_type), outputs, skipped))
 
-    for file_path, new_name, idx in files_to_process:
-        file_type = get_file_type(file_path.name)
-        output_path = output_dir / new_name
-
-        if verbose:
-            print(f"   Обработка: {file_path.name} → {new_name}")
-
-        result = optimizer.process_image(file_path, output_path, file_type)
+    # Изображения независимы друг от друга, поэтому кодируем их параллельно,
+    # а прогресс и статистику собираем в основном процессе по мере готовности
+    for (file_path, new_name, idx, file_type), result in _run_jobs(optimizer, jobs, parallel):
         results.append(result)
 
-        if result['success']:
+        # Запоминаем, из чего собран каждый выходной файл; после ошибки запись
+        # удаляем, чтобы следующий запуск не счёл битый файл актуальным
+        for out_path, record in records_by_idx[idx].items():
+            if result['success'] and out_path.exists():
+                manifest[out_path.name] = {'build': record, 'output_size': out_path.stat().st_size}
+            else:
+                manifest.pop(out_path.name, None)
+
+        if result.get('skipped'):
+            total_original_size += result['original_size']
+            total_new_size += result['new_size']
+            line = f"⏭️  {new_name:<20} без изменений"
+        elif result['success']:
             total_original_size += result['original_size']
             total_new_size += result['new_size']
-            print(f"✓ {new_name:<20} {format_size(result['original_size']):>8} → {format_size(result['new_size']):>8} ({result['compression']:>2}% сжатие)")
+            line = f"✓ {new_name:<20} {format_size(result['original_size']):>8} → {format_size(result['new_size']):>8} ({result['compression']:>2}% сжатие)"
         else:
-            print(f"✗ {file_path.name}: {result.get('error', 'Unknown error')}")
+            line = f"✗ {file_path.name}: {result.get('error', 'Unknown error')}"
+
+        if quiet_progress:
+            # Копим строки и пишем их одним вызовом
+            progress_buf.append(line + '\n')
+            if len(progress_buf) >= PROGRESS_FLUSH_EVERY:
+                sys.stdout.write(''.join(progress_buf))
+                progress_buf.clear()
+        else:
+            print(line)
+
+    if progress_buf:
+        sys.stdout.write(''.join(progress_buf))
+        progress_buf.clear()
+
+    save_manifest(output_dir, manifest)
 
     # Обновляем markdown
     print("\n📝 Обновление markdown...")
-    new_markdown = markdown_content
+    # idx - порядковый номер ссылки в image_refs, поэтому пропущенные
+    # ссылки (видео, отсутствующие файлы) не сдвигают соответствие
+    buf = io.StringIO()
+    cursor = 0
+
+    for file_path, new_name, idx, file_type in files_to_process:
+        (start, end), alt, old_path = image_refs[idx - 1]
 
-    for (full_match, alt, old_path), (file_path, new_name, idx) in zip(image_refs, files_to_process):
-        # Определяем новый путь (без Attachments/)
-        new_path = new_name
+        # Определяем новый путь (без Attachments/) и пишем markdown за один проход
+        buf.write(markdown_content[cursor:start])
+        buf.write('![')
+        buf.write(alt)
+        buf.write('](')
+        buf.write(new_name)
+        buf.write(')')
+        cursor = end
 
-        # Заменяем в markdown
-        new_match = f'![{alt}]({new_path})'
-        new_markdown = new_markdown.replace(full_match, new_match)
+    buf.write(markdown_content[cursor:])
 
     # Сохраняем обновленный markdown
     output_markdown = output_dir / markdown_file.name
-    with open(output_markdown, 'w', encoding='utf-8') as f:
-        f.write(new_markdown)
+    _write_atomic(output_markdown, lambda tmp: tmp.write_text(buf.getvalue(), encoding='utf-8'))
     print(f"✓ Markdown сохранен: {output_markdown.name}")
 
     # Копируем в Hugo blog если указан путь
@@ -382,14 +939,15 @@ def process_post(
         print(f"\n📦 Копирование в Hugo blog: {hugo_path}")
         hugo_path.mkdir(parents=True, exist_ok=True)
 
-        # Копируем markdown
-        shutil.copy2(output_markdown, hugo_path / markdown_file.name)
+        # Копируем markdown. Без hardlink: автор правит его прямо в Hugo blog,
+        # и правки не должны попадать в processed/ (и наоборот)
+        _fast_copy(output_markdown, hugo_path / markdown_file.name, hardlink=False)
 
-        # Копируем изображения
-        for file_path, new_name, idx in files_to_process:
-            output_file = output_dir / new_name
-            if output_file.exists():
-                shutil.copy2(output_file, hugo_path / new_name)
+        # Копируем изображения во всех выходных форматах
+        for file_path, new_name, idx, file_type in files_to_process:
+            for output_file, _, _ in optimizer.build_outputs(output_dir, Path(new_name).stem):
+                if output_file.exists():
+                    _fast_copy(output_file, hugo_path / output_file.name, hardlink)
 
         print(f"✓ Файлы скопированы в {hugo_path}")
 
@@ -401,6 +959,9 @@ def process_post(
         print(f"Файлов обработано: {len([r for r in results if r['success']])} из {len(results)}")
         if len(results) != len(files_to_process):
             print(f"Пропущено: {len(files_to_process) - len(results)}")
+        unchanged = len([r for r in results if r.get('skipped')])
+        if unchanged:
+            print(f"Без изменений (не перекодированы): {unchanged}")
         print(f"\nРазмер до:  {format_size(total_original_size)}")
         print(f"Размер после: {format_size(total_new_size)}")
         if total_original_size > 0:
@@ -485,6 +1046,58 @@ def main():
         default=95,
         help='Качество WebP 1-100 (по умолчанию: 95 - около максимального)'
     )
+    parser.add_argument(
+        '--webp-method',
+        type=int,
+        choices=range(7),
+        default=4,
+        metavar='0-6',
+        help='Метод сжатия WebP 0-6: больше - медленнее и чуть меньше (по умолчанию: 4)'
+    )
+    # --avif - сокращение для --formats avif, вместе их указывать нельзя
+    format_group = parser.add_mutually_exclusive_group()
+    format_group.add_argument(
+        '--avif',
+        action='store_true',
+        help='Сохранять в AVIF вместо WebP, то же что --formats avif '
+             '(нужен Pillow >= 11.2 или pillow-avif-plugin)'
+    )
+    format_group.add_argument(
+        '--formats',
+        type=str,
+        default='webp',
+        help='Выходные форматы через запятую, например webp,avif,jpeg. '
+             'Изображение декодируется один раз, в markdown ссылка на первый (по умолчанию: webp)'
+    )
+    parser.add_argument(
+        '--keep-metadata',
+        action='store_true',
+        help='Сохранять EXIF, ICC профиль и XMP исходника (по умолчанию удаляются)'
+    )
+    parser.add_argument(
+        '--backend',
+        choices=['pillow', 'vips'],
+        default='pillow',
+        help='Библиотека для ресайза и кодирования: vips быстрее и экономнее '
+             'по памяти на больших фото, нужен pyvips (по умолчанию: pillow)'
+    )
+    parser.add_argument(
+        '--parallel',
+        choices=['process', 'thread', 'none'],
+        default='process',
+        help='Параллельная обработка: процессы, потоки или последовательно (по умолчанию: process)'
+    )
+    parser.add_argument(
+        '--no-hardlink',
+        action='store_true',
+        help='Копировать файлы в Hugo blog вместо создания hardlink'
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Перекодировать все изображения, даже если они уже собраны '
+             'из тех же исходников с теми же настройками'
+    )
     parser.add_argument(
         '--dry-run',
         action='store_true',
@@ -495,11 +1108,21 @@ def main():
         action='store_true',
         help='Не переименовывать файлы в img_XX'
     )
+    parser.add_argument(
+        '--slow-fallback',
+        action='store_true',
+        help='Искать файлы по вхождению basename в имя (для имён вида file.jpeg.jpg)'
+    )
     parser.add_argument(
         '--verbose',
         action='store_true',
         help='Подробный вывод'
     )
+    parser.add_argument(
+        '--quiet-progress',
+        action='store_true',
+        help=f'Выводить прогресс пачками по {PROGRESS_FLUSH_EVERY} файлов, а не построчно'
+    )
     parser.add_argument(
         '--no-stats',
         action='store_true',
@@ -516,12 +1139,49 @@ def main():
     else:
         output_dir = source_dir / 'processed'
 
+    # dict.fromkeys убирает повторы, сохраняя порядок (первый формат - основной)
+    formats = ['avif'] if args.avif else list(dict.fromkeys(
+        fmt.strip().lower() for fmt in args.formats.split(',') if fmt.strip()
+    ))
+    unknown_formats = [fmt for fmt in formats if fmt not in FORMAT_EXTENSIONS]
+    if not formats or unknown_formats:
+        parser.error(f"неизвестный формат: {', '.join(unknown_formats) or args.formats} "
+                     f"(доступны: {', '.join(FORMAT_EXTENSIONS)})")
+
+    # Dry-run не кодирует изображения, поэтому и Pillow ему не нужен
+    if not args.dry_run:
+        try:
+            _load_pillow()
+        except ImportError:
+            print("❌ Ошибка: Не установлены необходимые библиотеки.")
+            print("Установите зависимости: pip install -r requirements.txt")
+            sys.exit(1)
+
+        if 'avif' in formats:
+            Image.init()
+            if 'AVIF' not in Image.SAVE:
+                print("❌ Ошибка: Pillow не поддерживает AVIF.")
+                print("Установите Pillow >= 11.2 или pillow-avif-plugin")
+                sys.exit(1)
+
+    if args.backend == 'vips' and not args.dry_run:
+        try:
+            _load_pyvips()
+        except ImportError:
+            print("❌ Ошибка: Для --backend vips нужен pyvips и libvips.")
+            print("Установите: pip install pyvips")
+            sys.exit(1)
+
     hugo_path = None
     if args.hugo_path:
         hugo_path = Path(args.hugo_path).expanduser().resolve()
 
     # Запускаем обработку
     print("🚀 Оптимизация изображений для Hugo блога\n")
+    # Собран ли Pillow с libjpeg-turbo (SIMD-декодирование JPEG)
+    if not args.dry_run and not features.check_feature('libjpeg_turbo'):
+        print("⚠️  Pillow собран без libjpeg-turbo: декодирование JPEG будет медленнее")
+        print("   См. комментарий в requirements.txt\n")
     success = process_post(
         source_dir=source_dir,
         output_dir=output_dir,
@@ -531,7 +1191,16 @@ def main():
         dry_run=args.dry_run,
         no_rename=args.no_rename,
         verbose=args.verbose,
-        stats=not args.no_stats
+        stats=not args.no_stats,
+        webp_method=args.webp_method,
+        formats=formats,
+        slow_fallback=args.slow_fallback,
+        hardlink=not args.no_hardlink,
+        backend=args.backend,
+        quiet_progress=args.quiet_progress,
+        parallel=args.parallel,
+        keep_metadata=args.keep_metadata,
+        force=args.force
     )
 
     if success: